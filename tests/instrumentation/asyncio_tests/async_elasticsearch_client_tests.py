@@ -30,7 +30,8 @@
 
 import pytest  # isort:skip
 
-from tests.instrumentation.elasticsearch_tests import get_kwargs
+# es_client is imported as a fixture: it installs the test index templates and is used for the cleanup
+from tests.instrumentation.elasticsearch_tests import TWEETS_INDEX, delete_indices, es_client, get_kwargs
 
 pytest.importorskip("elasticsearch._async")  # isort:skip
 
@@ -53,14 +54,16 @@ document_type = "_doc" if ES_VERSION[0] >= 6 else "doc"
 
 
 @pytest.fixture
-async def async_elasticsearch(request):
-    """AsyncElasticsearch client fixture."""
+async def async_elasticsearch(es_client):
+    """AsyncElasticsearch client fixture, cleaning up the only index these tests write to."""
+    # only touch this worker's index, other modules and xdist workers may be using the cluster at the same time
+    delete_indices(es_client, TWEETS_INDEX)
     client = AsyncElasticsearch(hosts=os.environ["ES_URL"])
     try:
         yield client
     finally:
-        await client.indices.delete(index="*")
         await client.close()
+        delete_indices(es_client, TWEETS_INDEX)
 
 
 async def test_ping(instrument, elasticapm_client, async_elasticsearch):
@@ -110,18 +113,20 @@ async def test_create(instrument, elasticapm_client, async_elasticsearch):
     iid = lambda: str(len(responses) + 1)
     if ES_VERSION[0] < 5:
         responses.append(
-            await async_elasticsearch.create("tweets", document_type, {"user": "kimchy", "text": "hola"}, iid())
+            await async_elasticsearch.create(TWEETS_INDEX, document_type, {"user": "kimchy", "text": "hola"}, iid())
         )
     elif ES_VERSION[0] < 7:
         responses.append(
-            await async_elasticsearch.create("tweets", document_type, iid(), body={"user": "kimchy", "text": "hola"})
+            await async_elasticsearch.create(
+                TWEETS_INDEX, document_type, iid(), body={"user": "kimchy", "text": "hola"}
+            )
         )
     elif ES_VERSION[0] < 8:
-        responses.append(await async_elasticsearch.create("tweets", iid(), body={"user": "kimchy", "text": "hola"}))
+        responses.append(await async_elasticsearch.create(TWEETS_INDEX, iid(), body={"user": "kimchy", "text": "hola"}))
     else:
         pass  # elasticsearch-py 8+ doesn't support positional arguments
     responses.append(
-        await async_elasticsearch.create(index="tweets", id=iid(), **get_kwargs({"user": "kimchy", "text": "hola"}))
+        await async_elasticsearch.create(index=TWEETS_INDEX, id=iid(), **get_kwargs({"user": "kimchy", "text": "hola"}))
     )
     elasticapm_client.end_transaction("test", "OK")
 
@@ -133,11 +138,11 @@ async def test_create(instrument, elasticapm_client, async_elasticsearch):
     for i, span in enumerate(spans):
         if ES_VERSION[0] >= 5:
             assert span["name"] in (
-                "ES PUT /tweets/%s/%d/_create" % (document_type, i + 1),
-                "ES PUT /tweets/_create/%d" % (i + 1),
+                f"ES PUT /{TWEETS_INDEX}/{document_type}/{i + 1}/_create",
+                f"ES PUT /{TWEETS_INDEX}/_create/{i + 1}",
             )
         else:
-            assert span["name"] == "ES PUT /tweets/%s/%d" % (document_type, i + 1)
+            assert span["name"] == f"ES PUT /{TWEETS_INDEX}/{document_type}/{i + 1}"
         assert span["type"] == "db"
         assert span["subtype"] == "elasticsearch"
         assert span["action"] == "query"
@@ -148,14 +153,19 @@ async def test_create(instrument, elasticapm_client, async_elasticsearch):
 
 async def test_search_body(instrument, elasticapm_client, async_elasticsearch):
     await async_elasticsearch.create(
-        index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola", "userid": 1})
+        index=TWEETS_INDEX, id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola", "userid": 1})
     )
     elasticapm_client.begin_transaction("test")
-    search_query = {"query": {"term": {"user": "kimchy"}}, "sort": ["userid"]}
+    # the request goes to all indices, but the query only matches this worker's tweets index
+    search_query = {
+        "query": {"bool": {"must": {"term": {"user": "kimchy"}}, "filter": {"term": {"_index": TWEETS_INDEX}}}},
+        "sort": ["userid"],
+    }
     result = await async_elasticsearch.search(body=search_query, params=None)
     elasticapm_client.end_transaction("test", "OK")
 
     transaction = elasticapm_client.events[TRANSACTION][0]
+    assert result["_shards"]["failed"] == 0
     assert result["hits"]["hits"][0]["_source"] == {"user": "kimchy", "text": "hola", "userid": 1}
     spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 1
@@ -166,11 +176,7 @@ async def test_search_body(instrument, elasticapm_client, async_elasticsearch):
     assert span["subtype"] == "elasticsearch"
     assert span["action"] == "query"
     assert span["context"]["db"]["type"] == "elasticsearch"
-    assert json.loads(span["context"]["db"]["statement"]) == json.loads(
-        '{"sort": ["userid"], "query": {"term": {"user": "kimchy"}}}'
-    ) or json.loads(span["context"]["db"]["statement"]) == json.loads(
-        '{"query": {"term": {"user": "kimchy"}}, "sort": ["userid"]}'
-    )
+    assert json.loads(span["context"]["db"]["statement"]) == search_query
     assert span["sync"] is False
     if ES_VERSION[0] >= 7:
         assert span["context"]["db"]["rows_affected"] == 1
@@ -179,10 +185,13 @@ async def test_search_body(instrument, elasticapm_client, async_elasticsearch):
 
 async def test_count_body(instrument, elasticapm_client, async_elasticsearch):
     await async_elasticsearch.create(
-        index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"})
+        index=TWEETS_INDEX, id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"})
     )
     elasticapm_client.begin_transaction("test")
-    search_query = {"query": {"term": {"user": "kimchy"}}}
+    # index-less like test_search_body, with the query limited to this worker's tweets index
+    search_query = {
+        "query": {"bool": {"must": {"term": {"user": "kimchy"}}, "filter": {"term": {"_index": TWEETS_INDEX}}}}
+    }
     result = await async_elasticsearch.count(body=search_query)
     elasticapm_client.end_transaction("test", "OK")
 
@@ -196,6 +205,6 @@ async def test_count_body(instrument, elasticapm_client, async_elasticsearch):
     assert span["subtype"] == "elasticsearch"
     assert span["action"] == "query"
     assert span["context"]["db"]["type"] == "elasticsearch"
-    assert json.loads(span["context"]["db"]["statement"]) == json.loads('{"query": {"term": {"user": "kimchy"}}}')
+    assert json.loads(span["context"]["db"]["statement"]) == search_query
     assert span["sync"] is False
     assert span["context"]["http"]["status_code"] == 200
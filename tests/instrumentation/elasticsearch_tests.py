@@ -28,38 +28,105 @@
 #  OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os  # isort:skip
+
 import pytest  # isort:skip
 
+if "ES_URL" not in os.environ:
+    # skip before anything below imports the elasticsearch client
+    pytest.skip("Skipping elasticsearch test, no ES_URL environment variable", allow_module_level=True)
+
 pytest.importorskip("elasticsearch")  # isort:skip
 
 import json
-import os
 import urllib.parse
+from contextlib import contextmanager
 
 from elasticsearch import VERSION as ES_VERSION
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import SerializationError
 from elasticsearch.serializer import JSONSerializer
 
 import elasticapm
 from elasticapm.conf.constants import TRANSACTION
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+json_loads = orjson.loads if orjson else json.loads
+
 pytestmark = [pytest.mark.elasticsearch]
 
-if "ES_URL" not in os.environ:
-    pytestmark.append(pytest.mark.skip("Skipping elasticsearch test, no ES_URL environment variable"))
+ES_URL = os.environ["ES_URL"]
+PARSED_ES_URL = urllib.parse.urlparse(ES_URL)
 
 
 document_type = "_doc" if ES_VERSION[0] >= 6 else "doc"
 
-
-def get_kwargs(document=None, document_kwarg_name="document"):
-    if ES_VERSION[0] < 6:
-        return {"doc_type": "doc", "body": document} if document else {"doc_type": "doc"}
-    if ES_VERSION[0] < 7:
-        return {"doc_type": "_doc", "body": document} if document else {"doc_type": "_doc"}
-    elif ES_VERSION[0] < 8:
+# Namespace the indices per pytest-xdist worker, so parallel workers don't clean up each other's data
+INDEX_SUFFIX = "-" + os.environ["PYTEST_XDIST_WORKER"] if "PYTEST_XDIST_WORKER" in os.environ else ""
+TWEETS_INDEX = "tweets" + INDEX_SUFFIX
+SNAPS_INDEX = "snaps" + INDEX_SUFFIX
+TEST_INDEX = "test-index" + INDEX_SUFFIX
+TEST_INDICES = (TWEETS_INDEX, SNAPS_INDEX, TEST_INDEX)
+# Seeded once per session for the read-only tests, and not cleaned up between tests
+READ_INDEX = "tweets-read" + INDEX_SUFFIX
+
+# Expected span names, built once instead of in every assertion
+if ES_VERSION[0] >= 5:
+    CREATE_SPAN_NAMES = tuple(
+        frozenset(
+            (
+                f"ES PUT /{TWEETS_INDEX}/{document_type}/{i}/_create",
+                f"ES PUT /{TWEETS_INDEX}/_create/{i}",
+                f"ES PUT /{TWEETS_INDEX}/_create/{i}?refresh=true",
+            )
+        )
+        for i in (1, 2)
+    )
+else:
+    CREATE_SPAN_NAMES = tuple(frozenset((f"ES PUT /{TWEETS_INDEX}/{document_type}/{i}",)) for i in (1, 2))
+INDEX_SPAN_NAMES = frozenset((f"ES POST /{TWEETS_INDEX}/{document_type}", f"ES POST /{TWEETS_INDEX}/_doc?refresh=true"))
+EXISTS_SPAN_NAME = f"ES HEAD /{READ_INDEX}/{document_type}/1"
+EXISTS_SOURCE_SPAN_NAMES = frozenset(
+    (f"ES HEAD /{READ_INDEX}/{document_type}/1/_source", f"ES HEAD /{READ_INDEX}/_source/1")
+)
+GET_SPAN_NAME = f"ES GET /{READ_INDEX}/{document_type}/1"
+GET_SOURCE_SPAN_NAMES = frozenset(
+    (f"ES GET /{READ_INDEX}/{document_type}/1/_source", f"ES GET /{READ_INDEX}/_source/1")
+)
+UPDATE_SPAN_NAMES = frozenset(
+    (f"ES POST /{TWEETS_INDEX}/_update/1", f"ES POST /{TWEETS_INDEX}/{document_type}/1/_update")
+)
+DELETE_SPAN_NAME = f"ES DELETE /{TWEETS_INDEX}/{document_type}/1"
+# Depending on ES_VERSION, searches without an index could be /_all/_search or /_search, and GET or POST.
+# Technically no version does `POST /_all/_count` but it's included anyway.
+SEARCH_SPAN_NAMES = frozenset(("ES GET /_search", "ES GET /_all/_search", "ES POST /_search"))
+COUNT_SPAN_NAMES = frozenset(("ES GET /_count", "ES GET /_all/_count", "ES POST /_count", "ES POST /_all/_count"))
+READ_SEARCH_SPAN_NAMES = frozenset((f"ES GET /{READ_INDEX}/_search", f"ES POST /{READ_INDEX}/_search"))
+READ_COUNT_SPAN_NAMES = frozenset((f"ES GET /{READ_INDEX}/_count", f"ES POST /{READ_INDEX}/_count"))
+MULTIPLE_INDEXES_SEARCH_SPAN_NAMES = frozenset(
+    (f"ES GET /{TWEETS_INDEX},{SNAPS_INDEX}/_search", f"ES POST /{TWEETS_INDEX},{SNAPS_INDEX}/_search")
+)
+MULTIPLE_INDEXES_DOCTYPES_SEARCH_SPAN_NAME = f"ES GET /{TWEETS_INDEX},{SNAPS_INDEX}/users,posts/_search"
+
+
+# ES_VERSION is fixed for the lifetime of the process, so pick the matching get_kwargs once at import time
+if ES_VERSION[0] < 7:
+
+    def get_kwargs(document=None, document_kwarg_name="document"):
+        return {"doc_type": document_type, "body": document} if document else {"doc_type": document_type}
+
+elif ES_VERSION[0] < 8:
+
+    def get_kwargs(document=None, document_kwarg_name="document"):
         return {"body": document} if document else {}
-    else:
+
+else:
+
+    def get_kwargs(document=None, document_kwarg_name="document"):
         return {document_kwarg_name: document} if document else {}
 
 
@@ -68,488 +135,477 @@ class NumberObj:
         self.value = value
 
 
+# The encoding helpers use exact type checks: NumberObj is never subclassed, and the test payloads are plain dicts
+def has_number_obj_keys(obj):
+    """Check, without copying anything, whether obj or any dict nested in it has a NumberObj key."""
+    stack = [obj] if type(obj) is dict else []
+    while stack:
+        for key, value in stack.pop().items():
+            if type(key) is NumberObj:
+                return True
+            if type(value) is dict:
+                stack.append(value)
+    return False
+
+
 class SpecialEncoder(JSONSerializer):
     def default(self, obj):
-        if isinstance(obj, NumberObj):
+        if type(obj) is NumberObj:
             return obj.value
         return JSONSerializer.default(self, obj)
 
     def force_key_encoding(self, obj):
-        if isinstance(obj, dict):
+        if type(obj) is not dict:
+            return obj
+        result = {}
+        for key, value in obj.items():
+            if type(key) is NumberObj:
+                key = self.default(key)
+            result[key] = self.force_key_encoding(value) if type(value) is dict else value
+        return result
+
+    def dumps(self, obj):
+        if has_number_obj_keys(obj):
+            obj = self.force_key_encoding(obj)
+        if orjson is None or isinstance(obj, (str, bytes)):
+            return super(SpecialEncoder, self).dumps(obj)
+        # orjson returns UTF-8 encoded bytes, which all supported clients accept as a request body.
+        # NumberObj keys have been turned into ints at this point, hence OPT_NON_STR_KEYS.
+        try:
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError as e:
+            # the stock serializer raises SerializationError for unserializable objects, and so should this
+            raise SerializationError(str(e)) from e
+
+
+def seed(client, docs):
+    """Index (metadata, document) pairs with a single bulk request and one refresh."""
+    lines = []
+    for metadata, document in docs:
+        if ES_VERSION[0] < 7:
+            # mapping types are mandatory before 7.x. Don't pass doc_type to bulk() for this, as that puts it in the
+            # URL path, where the server reads it as the default index.
+            metadata = dict({"_type": document_type}, **metadata)
+        lines.append(json.dumps({"index": metadata}) + "\n" + json.dumps(document) + "\n")
+    if ES_VERSION[0] >= 8:
+        result = client.bulk(operations="".join(lines), refresh=True)
+    else:
+        result = client.bulk(body="".join(lines), refresh=True)
+    assert not result["errors"]
 
-            def yield_key_value(d):
-                for key, value in d.items():
-                    try:
-                        yield self.default(key), self.force_key_encoding(value)
-                    except TypeError:
-                        yield key, self.force_key_encoding(value)
 
-            return dict(yield_key_value(obj))
+def delete_indices(client, *indices):
+    """Delete the given indices, ignoring the ones that don't exist."""
+    # ignore_unavailable isn't accepted by indices.delete() on the older clients, and a missing index in a
+    # comma-separated list fails the whole request, so delete them one by one and ignore the 404s
+    for index in indices:
+        if ES_VERSION[0] >= 8:
+            client.options(ignore_status=404).indices.delete(index=index)
         else:
-            return obj
+            client.indices.delete(index=index, ignore=404)
+
+
+# Single-node test cluster: no replicas, and only refresh when a test explicitly asks for it
+TEST_INDEX_TEMPLATES = {"apm-tests-" + index: index for index in TEST_INDICES + (READ_INDEX,)}
+TEST_INDEX_SETTINGS = {"number_of_replicas": 0, "refresh_interval": "-1"}
+# Index-less searches sort on userid, which fails on the shards of every index that doesn't map it. Mapping types
+# are still required before 7.x, and _default_ applies to all of them.
+TEST_INDEX_PROPERTIES = {"userid": {"type": "long"}}
+if ES_VERSION[0] >= 7:
+    TEST_INDEX_MAPPINGS = {"properties": TEST_INDEX_PROPERTIES}
+else:
+    TEST_INDEX_MAPPINGS = {"_default_": {"properties": TEST_INDEX_PROPERTIES}}
+
+
+def assert_db_span(span, status_code=200, expect_statement=False):
+    """Assert the attributes shared by all Elasticsearch spans."""
+    context = span["context"]
+    assert (span["type"], span["subtype"], span["action"]) == ("db", "elasticsearch", "query")
+    assert context["db"]["type"] == "elasticsearch"
+    assert context["http"]["status_code"] == status_code
+    if expect_statement:
+        assert "statement" in context["db"]
+    else:
+        assert "statement" not in context["db"]
+
+
+# Gzip request bodies and keep enough pooled connections around for all tests. 8.x renamed the pool size and
+# timeout options, and http_compress was only added in 6.3.
+if ES_VERSION[0] >= 8:
+    ES_CLIENT_KWARGS = {"http_compress": True, "connections_per_node": 16, "request_timeout": 30}
+elif ES_VERSION >= (6, 3):
+    ES_CLIENT_KWARGS = {"http_compress": True, "maxsize": 16, "timeout": 30}
+else:
+    ES_CLIENT_KWARGS = {"maxsize": 16, "timeout": 30}
+
+
+@pytest.fixture(scope="session")
+def es_client():
+    """Elasticsearch client shared by all tests, so its connection pool stays warm."""
+    client = Elasticsearch(hosts=ES_URL, serializer=SpecialEncoder(), **ES_CLIENT_KWARGS)
+    patterns_key = "index_patterns" if ES_VERSION[0] >= 6 else "template"
+    for name, pattern in TEST_INDEX_TEMPLATES.items():
+        client.indices.put_template(
+            name=name,
+            body={patterns_key: pattern, "settings": TEST_INDEX_SETTINGS, "mappings": TEST_INDEX_MAPPINGS},
+        )
+    try:
+        yield client
+    finally:
+        delete_indices(client, *TEST_INDICES)
+        for name in TEST_INDEX_TEMPLATES:
+            client.indices.delete_template(name=name)
 
-    def dumps(self, obj):
-        return super(SpecialEncoder, self).dumps(self.force_key_encoding(obj))
+
+@pytest.fixture
+def elasticsearch(es_client):
+    """Elasticsearch client fixture, with the test indices removed before each test."""
+    delete_indices(es_client, *TEST_INDICES)
+    yield es_client
 
 
 @pytest.fixture
-def elasticsearch(request):
-    """Elasticsearch client fixture."""
-    client = Elasticsearch(hosts=os.environ["ES_URL"], serializer=SpecialEncoder())
-    client.indices.delete(index="*")
+def transaction_spans(elasticapm_client):
+    """Context manager that runs its block in a transaction and fills the yielded list with the resulting spans."""
+
+    @contextmanager
+    def run_transaction():
+        spans = []
+        elasticapm_client.begin_transaction("test")
+        try:
+            yield spans
+        finally:
+            # end the transaction even if the block raised, so it doesn't leak into the next test
+            elasticapm_client.end_transaction("test", "OK")
+        transaction = elasticapm_client.events[TRANSACTION][0]
+        spans.extend(elasticapm_client.spans_for_transaction(transaction))
+
+    return run_transaction
+
+
+@pytest.fixture(scope="module")
+def seeded_elasticsearch(es_client):
+    """Elasticsearch client with a single tweet in READ_INDEX, indexed once for the read-only tests of this module."""
+    # module scoped, so the document doesn't show up in index-less searches of other modules
+    delete_indices(es_client, READ_INDEX)
+    seed(es_client, [({"_index": READ_INDEX, "_id": "1"}, {"user": "kimchy", "text": "hola"})])
     try:
-        yield client
+        yield es_client
     finally:
-        client.indices.delete(index="*")
+        delete_indices(es_client, READ_INDEX)
 
 
 @pytest.mark.integrationtest
-def test_ping(instrument, elasticapm_client, elasticsearch):
-    elasticapm_client.begin_transaction("test")
-    result = elasticsearch.ping()
-    elasticapm_client.end_transaction("test", "OK")
-    parsed_url = urllib.parse.urlparse(os.environ["ES_URL"])
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
-    spans = elasticapm_client.spans_for_transaction(transaction)
+def test_ping(instrument, transaction_spans, elasticsearch):
+    with transaction_spans() as spans:
+        result = elasticsearch.ping()
+
     assert len(spans) == 1
     span = spans[0]
     assert span["name"] == "ES HEAD /"
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
+    assert_db_span(span)
     assert span["context"]["destination"] == {
-        "address": parsed_url.hostname,
-        "port": parsed_url.port,
+        "address": PARSED_ES_URL.hostname,
+        "port": PARSED_ES_URL.port,
         "service": {"name": "", "resource": "elasticsearch", "type": ""},
     }
-    assert span["context"]["http"]["status_code"] == 200
 
 
 @pytest.mark.integrationtest
-def test_info(instrument, elasticapm_client, elasticsearch):
-    elasticapm_client.begin_transaction("test")
-    result = elasticsearch.info()
-    elasticapm_client.end_transaction("test", "OK")
+def test_info(instrument, transaction_spans, elasticsearch):
+    with transaction_spans() as spans:
+        result = elasticsearch.info()
 
-    transaction = elasticapm_client.events[TRANSACTION][0]
-
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 1
     span = spans[0]
     assert span["name"] == "ES GET /"
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["http"]["status_code"] == 200
+    assert_db_span(span)
 
 
 @pytest.mark.integrationtest
-def test_create(instrument, elasticapm_client, elasticsearch):
-    elasticapm_client.begin_transaction("test")
-    elasticsearch.create(index="tweets", id="1", **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticsearch.create(
-        index="tweets",
-        id="2",
-        refresh=True,
-        **get_kwargs({"user": "kimchy", "text": "hola"}),
-    )
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
+def test_create(instrument, transaction_spans, elasticsearch):
+    with transaction_spans() as spans:
+        elasticsearch.create(index=TWEETS_INDEX, id="1", **get_kwargs({"user": "kimchy", "text": "hola"}))
+        elasticsearch.create(
+            index=TWEETS_INDEX,
+            id="2",
+            refresh=True,
+            **get_kwargs({"user": "kimchy", "text": "hola"}),
+        )
 
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 2
 
     for i, span in enumerate(spans):
-        if ES_VERSION[0] >= 5:
-            assert span["name"] in (
-                "ES PUT /tweets/%s/%d/_create" % (document_type, i + 1),
-                "ES PUT /tweets/_create/%d" % (i + 1),
-                "ES PUT /tweets/_create/%d?refresh=true" % (i + 1),
-            )
-        else:
-            assert span["name"] == "ES PUT /tweets/%s/%d" % (document_type, i + 1)
-        assert span["type"] == "db"
-        assert span["subtype"] == "elasticsearch"
-        assert span["action"] == "query"
-        assert span["context"]["db"]["type"] == "elasticsearch"
-        assert "statement" not in span["context"]["db"]
-        assert span["context"]["http"]["status_code"] == 201
+        assert span["name"] in CREATE_SPAN_NAMES[i]
+        assert_db_span(span, status_code=201)
 
 
 @pytest.mark.integrationtest
-def test_index(instrument, elasticapm_client, elasticsearch):
-    elasticapm_client.begin_transaction("test")
-    r1 = elasticsearch.index(index="tweets", **get_kwargs({"user": "kimchy", "text": "hola"}))
-    r2 = elasticsearch.index(index="tweets", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.end_transaction("test", "OK")
+def test_index(instrument, transaction_spans, elasticsearch):
+    with transaction_spans() as spans:
+        r1 = elasticsearch.index(index=TWEETS_INDEX, **get_kwargs({"user": "kimchy", "text": "hola"}))
+        r2 = elasticsearch.index(index=TWEETS_INDEX, refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
 
-    transaction = elasticapm_client.events[TRANSACTION][0]
-
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 2
 
     for span in spans:
-        assert span["name"] in ("ES POST /tweets/%s" % document_type, "ES POST /tweets/_doc?refresh=true")
-        assert span["type"] == "db"
-        assert span["subtype"] == "elasticsearch"
-        assert span["action"] == "query"
-        assert span["context"]["db"]["type"] == "elasticsearch"
-        assert "statement" not in span["context"]["db"]
-        assert span["context"]["http"]["status_code"] == 201
+        assert span["name"] in INDEX_SPAN_NAMES
+        assert_db_span(span, status_code=201)
 
 
 @pytest.mark.integrationtest
-def test_exists(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    result = elasticsearch.exists(id="1", index="tweets", **get_kwargs())
-    elasticapm_client.end_transaction("test", "OK")
+def test_exists(instrument, transaction_spans, seeded_elasticsearch):
+    with transaction_spans() as spans:
+        result = seeded_elasticsearch.exists(id="1", index=READ_INDEX, **get_kwargs())
 
-    transaction = elasticapm_client.events[TRANSACTION][0]
     assert result
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 1
     span = spans[0]
-    assert span["name"] == "ES HEAD /tweets/%s/1" % document_type
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
-    assert span["context"]["http"]["status_code"] == 200
+    assert span["name"] == EXISTS_SPAN_NAME
+    assert_db_span(span)
 
 
 @pytest.mark.skipif(ES_VERSION[0] < 5, reason="unsupported method")
 @pytest.mark.integrationtest
-def test_exists_source(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    if ES_VERSION[0] < 7:
-        assert elasticsearch.exists_source("tweets", document_type, 1) is True
-    else:
-        assert bool(elasticsearch.exists_source(index="tweets", id="1", **get_kwargs())) is True
-    assert bool(elasticsearch.exists_source(index="tweets", id="1", **get_kwargs())) is True
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
+def test_exists_source(instrument, transaction_spans, seeded_elasticsearch):
+    with transaction_spans() as spans:
+        if ES_VERSION[0] < 7:
+            assert seeded_elasticsearch.exists_source(READ_INDEX, document_type, 1) is True
+        else:
+            assert bool(seeded_elasticsearch.exists_source(index=READ_INDEX, id="1", **get_kwargs())) is True
+        assert bool(seeded_elasticsearch.exists_source(index=READ_INDEX, id="1", **get_kwargs())) is True
 
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 2
 
     for span in spans:
-        assert span["name"] in ("ES HEAD /tweets/%s/1/_source" % document_type, "ES HEAD /tweets/_source/1")
-        assert span["type"] == "db"
-        assert span["subtype"] == "elasticsearch"
-        assert span["action"] == "query"
-        assert span["context"]["db"]["type"] == "elasticsearch"
-        assert "statement" not in span["context"]["db"]
-        assert span["context"]["http"]["status_code"] == 200
+        assert span["name"] in EXISTS_SOURCE_SPAN_NAMES
+        assert_db_span(span)
 
 
 @pytest.mark.integrationtest
-def test_get(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    # this is a fun one. Order pre-6x was (index, id, doc_type), changed to (index, doc_type, id) in 6.x, and reverted
-    # to (index, id, doc_type) in 7.x. OK then.
-    if ES_VERSION[0] == 6:
-        r1 = elasticsearch.get("tweets", document_type, 1)
-    else:
-        r1 = elasticsearch.get(index="tweets", id="1", **get_kwargs())
-    r2 = elasticsearch.get(index="tweets", id="1", **get_kwargs())
-    elasticapm_client.end_transaction("test", "OK")
+def test_get(instrument, transaction_spans, seeded_elasticsearch):
+    with transaction_spans() as spans:
+        # this is a fun one. Order pre-6x was (index, id, doc_type), changed to (index, doc_type, id) in 6.x, and
+        # reverted to (index, id, doc_type) in 7.x. OK then.
+        if ES_VERSION[0] == 6:
+            r1 = seeded_elasticsearch.get(READ_INDEX, document_type, 1)
+        else:
+            r1 = seeded_elasticsearch.get(index=READ_INDEX, id="1", **get_kwargs())
+        r2 = seeded_elasticsearch.get(index=READ_INDEX, id="1", **get_kwargs())
 
-    transaction = elasticapm_client.events[TRANSACTION][0]
     for r in (r1, r2):
         assert r["found"]
         assert r["_source"] == {"user": "kimchy", "text": "hola"}
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 2
 
     for span in spans:
-        assert span["name"] == "ES GET /tweets/%s/1" % document_type
-        assert span["type"] == "db"
-        assert span["subtype"] == "elasticsearch"
-        assert span["action"] == "query"
-        assert span["context"]["db"]["type"] == "elasticsearch"
-        assert "statement" not in span["context"]["db"]
-        assert span["context"]["http"]["status_code"] == 200
+        assert span["name"] == GET_SPAN_NAME
+        assert_db_span(span)
 
 
 @pytest.mark.integrationtest
-def test_get_source(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", refresh=True, id="1", **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    if ES_VERSION[0] < 7:
-        r1 = elasticsearch.get_source("tweets", document_type, 1)
-    else:
-        r1 = elasticsearch.get_source(index="tweets", id="1", **get_kwargs())
-    r2 = elasticsearch.get_source(index="tweets", id="1", **get_kwargs())
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
+def test_get_source(instrument, transaction_spans, seeded_elasticsearch):
+    with transaction_spans() as spans:
+        if ES_VERSION[0] < 7:
+            r1 = seeded_elasticsearch.get_source(READ_INDEX, document_type, 1)
+        else:
+            r1 = seeded_elasticsearch.get_source(index=READ_INDEX, id="1", **get_kwargs())
+        r2 = seeded_elasticsearch.get_source(index=READ_INDEX, id="1", **get_kwargs())
 
     for r in (r1, r2):
         assert r == {"user": "kimchy", "text": "hola"}
 
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 2
 
     for span in spans:
-        assert span["name"] in ("ES GET /tweets/%s/1/_source" % document_type, "ES GET /tweets/_source/1")
-        assert span["type"] == "db"
-        assert span["subtype"] == "elasticsearch"
-        assert span["action"] == "query"
-        assert span["context"]["db"]["type"] == "elasticsearch"
-        assert "statement" not in span["context"]["db"]
-        assert span["context"]["http"]["status_code"] == 200
+        assert span["name"] in GET_SOURCE_SPAN_NAMES
+        assert_db_span(span)
 
 
 @pytest.mark.integrationtest
-def test_update_document(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    r1 = elasticsearch.update(index="tweets", id=1, body={"doc": {"text": "adios"}}, refresh=True, **get_kwargs())
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
-    r2 = elasticsearch.get(index="tweets", id="1", **get_kwargs())
+def test_update_document(instrument, transaction_spans, elasticsearch):
+    elasticsearch.create(index=TWEETS_INDEX, id="1", **get_kwargs({"user": "kimchy", "text": "hola"}))
+    with transaction_spans() as spans:
+        r1 = elasticsearch.update(
+            index=TWEETS_INDEX, id=1, body={"doc": {"text": "adios"}}, refresh=True, **get_kwargs()
+        )
+
+    r2 = elasticsearch.get(index=TWEETS_INDEX, id="1", **get_kwargs())
     assert r2["_source"] == {"user": "kimchy", "text": "adios"}
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 1
 
     span = spans[0]
-    assert span["name"] in ("ES POST /tweets/_update/1", "ES POST /tweets/%s/1/_update" % document_type)
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
-    assert "statement" not in span["context"]["db"]
-    assert span["context"]["http"]["status_code"] == 200
+    assert span["name"] in UPDATE_SPAN_NAMES
+    assert_db_span(span)
 
 
 @pytest.mark.integrationtest
-def test_search_body(instrument, elasticapm_client, elasticsearch):
+def test_search_body(instrument, transaction_spans, elasticsearch):
     elasticsearch.create(
-        index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola", "userid": 1})
+        index=TWEETS_INDEX, id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola", "userid": 1})
     )
-    elasticapm_client.begin_transaction("test")
-    search_query = {"query": {"term": {"user": "kimchy"}}, "sort": ["userid"]}
-    result = elasticsearch.search(body=search_query)
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
-    assert result["hits"]["hits"][0]["_source"] == {"user": "kimchy", "text": "hola", "userid": 1}
-    spans = elasticapm_client.spans_for_transaction(transaction)
+    with transaction_spans() as spans:
+        # the request goes to all indices, but the query only matches this worker's tweets index, so the seeded
+        # read-only index and other xdist workers' documents don't show up in the hits
+        search_query = {
+            "query": {"bool": {"must": {"term": {"user": "kimchy"}}, "filter": {"term": {"_index": TWEETS_INDEX}}}},
+            "sort": ["userid"],
+        }
+        result = elasticsearch.search(body=search_query)
+
+    assert result["_shards"]["failed"] == 0
+    assert [hit["_source"] for hit in result["hits"]["hits"]] == [{"user": "kimchy", "text": "hola", "userid": 1}]
     assert len(spans) == 1
     span = spans[0]
-    # Depending on ES_VERSION, could be /_all/_search or /_search, and GET or POST
-    assert span["name"] in ("ES GET /_search", "ES GET /_all/_search", "ES POST /_search")
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
-    assert json.loads(span["context"]["db"]["statement"]) == json.loads(
-        '{"sort": ["userid"], "query": {"term": {"user": "kimchy"}}}'
-    ) or json.loads(span["context"]["db"]["statement"]) == json.loads(
-        '{"query": {"term": {"user": "kimchy"}}, "sort": ["userid"]}'
-    )
+    assert span["name"] in SEARCH_SPAN_NAMES
+    assert_db_span(span, expect_statement=True)
+    # dict equality doesn't depend on key order, so the body can be compared to the query directly
+    assert json_loads(span["context"]["db"]["statement"]) == search_query
     if ES_VERSION[0] >= 6:
         assert span["context"]["db"]["rows_affected"] == 1
-    assert span["context"]["http"]["status_code"] == 200
 
 
 @pytest.mark.integrationtest
-def test_search_querystring(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    search_query = "user:kimchy"
-    result = elasticsearch.search(q=search_query, index="tweets")
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
+def test_search_querystring(instrument, transaction_spans, seeded_elasticsearch):
+    with transaction_spans() as spans:
+        search_query = "user:kimchy"
+        result = seeded_elasticsearch.search(q=search_query, index=READ_INDEX)
+
     assert result["hits"]["hits"][0]["_source"] == {"user": "kimchy", "text": "hola"}
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 1
     span = spans[0]
     # Starting in 7.5.1, these turned into POST instead of GET. That detail is
     # unimportant for these tests.
-    assert span["name"] in ("ES GET /tweets/_search", "ES POST /tweets/_search")
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
+    assert span["name"] in READ_SEARCH_SPAN_NAMES
+    assert_db_span(span, expect_statement=True)
     assert span["context"]["db"]["statement"] == "q=user:kimchy"
     if ES_VERSION[0] >= 6:
         assert span["context"]["db"]["rows_affected"] == 1
-    assert span["context"]["http"]["status_code"] == 200
 
 
 @pytest.mark.integrationtest
-def test_search_both(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    search_querystring = "text:hola"
-    search_query = {"query": {"term": {"user": "kimchy"}}}
-    result = elasticsearch.search(body=search_query, q=search_querystring, index="tweets")
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
+def test_search_both(instrument, transaction_spans, seeded_elasticsearch):
+    with transaction_spans() as spans:
+        search_querystring = "text:hola"
+        search_query = {"query": {"term": {"user": "kimchy"}}}
+        result = seeded_elasticsearch.search(body=search_query, q=search_querystring, index=READ_INDEX)
+
     assert len(result["hits"]["hits"]) == 1
     assert result["hits"]["hits"][0]["_source"] == {"user": "kimchy", "text": "hola"}
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 1
     span = spans[0]
     # Starting in 7.6.0, these turned into POST instead of GET. That detail is
     # unimportant for these tests.
-    assert span["name"] in ("ES GET /tweets/_search", "ES POST /tweets/_search")
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
+    assert span["name"] in READ_SEARCH_SPAN_NAMES
+    assert_db_span(span, expect_statement=True)
     assert span["context"]["db"]["statement"].startswith('q=text:hola\n\n{"query":')
-    assert span["context"]["http"]["status_code"] == 200
 
 
 @pytest.mark.integrationtest
-def test_count_body(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    search_query = {"query": {"term": {"user": "kimchy"}}}
-    result = elasticsearch.count(body=search_query)
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
+def test_count_body(instrument, transaction_spans, elasticsearch):
+    elasticsearch.create(index=TWEETS_INDEX, id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
+    with transaction_spans() as spans:
+        # index-less like test_search_body, with the query limited to this worker's tweets index
+        search_query = {
+            "query": {"bool": {"must": {"term": {"user": "kimchy"}}, "filter": {"term": {"_index": TWEETS_INDEX}}}}
+        }
+        result = elasticsearch.count(body=search_query)
+
     assert result["count"] == 1
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 1
     span = spans[0]
-    # Depending on ES_VERSION, could be /_all/_count or /_count, and either GET
-    # or POST. None of these details actually matter much for this test.
-    # Technically no version does `POST /_all/_count` but I added it anyway
-    assert span["name"] in ("ES GET /_count", "ES GET /_all/_count", "ES POST /_count", "ES POST /_all/_count")
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
-    assert json.loads(span["context"]["db"]["statement"]) == json.loads('{"query": {"term": {"user": "kimchy"}}}')
-    assert span["context"]["http"]["status_code"] == 200
+    assert span["name"] in COUNT_SPAN_NAMES
+    assert_db_span(span, expect_statement=True)
+    assert json_loads(span["context"]["db"]["statement"]) == search_query
 
 
 @pytest.mark.integrationtest
-def test_count_querystring(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    search_query = "user:kimchy"
-    result = elasticsearch.count(q=search_query, index="tweets")
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
+def test_count_querystring(instrument, transaction_spans, seeded_elasticsearch):
+    with transaction_spans() as spans:
+        search_query = "user:kimchy"
+        result = seeded_elasticsearch.count(q=search_query, index=READ_INDEX)
+
     assert result["count"] == 1
-    spans = elasticapm_client.spans_for_transaction(transaction)
     assert len(spans) == 1
     span = spans[0]
     # Starting in 7.5.1, these turned into POST instead of GET. That detail is
     # unimportant for these tests.
-    assert span["name"] in ("ES GET /tweets/_count", "ES POST /tweets/_count")
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
+    assert span["name"] in READ_COUNT_SPAN_NAMES
+    assert_db_span(span, expect_statement=True)
     assert span["context"]["db"]["statement"] == "q=user:kimchy"
-    assert span["context"]["http"]["status_code"] == 200
 
 
 @pytest.mark.integrationtest
-def test_delete(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    result = elasticsearch.delete(id="1", index="tweets", **get_kwargs())
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
-    spans = elasticapm_client.spans_for_transaction(transaction)
+def test_delete(instrument, transaction_spans, elasticsearch):
+    elasticsearch.create(index=TWEETS_INDEX, id="1", **get_kwargs({"user": "kimchy", "text": "hola"}))
+    with transaction_spans() as spans:
+        result = elasticsearch.delete(id="1", index=TWEETS_INDEX, **get_kwargs())
 
     span = spans[0]
-    assert span["name"] == "ES DELETE /tweets/%s/1" % document_type
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
-    assert span["context"]["http"]["status_code"] == 200
+    assert span["name"] == DELETE_SPAN_NAME
+    assert_db_span(span)
 
 
 @pytest.mark.integrationtest
-def test_multiple_indexes(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticsearch.create(index="snaps", id="1", refresh=True, **get_kwargs({"user": "kimchy", "text": "hola"}))
-    elasticapm_client.begin_transaction("test")
-    result = elasticsearch.search(index=["tweets", "snaps"], q="user:kimchy")
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
-    spans = elasticapm_client.spans_for_transaction(transaction)
+def test_multiple_indexes(instrument, transaction_spans, elasticsearch):
+    seed(
+        elasticsearch,
+        [
+            ({"_index": TWEETS_INDEX, "_id": "1"}, {"user": "kimchy", "text": "hola"}),
+            ({"_index": SNAPS_INDEX, "_id": "1"}, {"user": "kimchy", "text": "hola"}),
+        ],
+    )
+    with transaction_spans() as spans:
+        result = elasticsearch.search(index=[TWEETS_INDEX, SNAPS_INDEX], q="user:kimchy")
+
     assert len(spans) == 1
     span = spans[0]
     # Starting in 7.6.0, these turned into POST instead of GET. That detail is
     # unimportant for these tests.
-    assert span["name"] in ("ES GET /tweets,snaps/_search", "ES POST /tweets,snaps/_search")
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
-    assert span["context"]["http"]["status_code"] == 200
+    assert span["name"] in MULTIPLE_INDEXES_SEARCH_SPAN_NAMES
+    assert_db_span(span, expect_statement=True)
 
 
 @pytest.mark.skipif(ES_VERSION[0] >= 7, reason="doc_type unsupported")
 @pytest.mark.integrationtest
-def test_multiple_indexes_doctypes(instrument, elasticapm_client, elasticsearch):
-    elasticsearch.create(index="tweets", doc_type="users", id=1, body={"user": "kimchy", "text": "hola"}, refresh=True)
-    elasticsearch.create(index="snaps", doc_type="posts", id=1, body={"user": "kimchy", "text": "hola"}, refresh=True)
-    elasticapm_client.begin_transaction("test")
-    result = elasticsearch.search(index=["tweets", "snaps"], doc_type=["users", "posts"], q="user:kimchy")
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
-    spans = elasticapm_client.spans_for_transaction(transaction)
+def test_multiple_indexes_doctypes(instrument, transaction_spans, elasticsearch):
+    seed(
+        elasticsearch,
+        [
+            ({"_index": TWEETS_INDEX, "_type": "users", "_id": "1"}, {"user": "kimchy", "text": "hola"}),
+            ({"_index": SNAPS_INDEX, "_type": "posts", "_id": "1"}, {"user": "kimchy", "text": "hola"}),
+        ],
+    )
+    with transaction_spans() as spans:
+        result = elasticsearch.search(index=[TWEETS_INDEX, SNAPS_INDEX], doc_type=["users", "posts"], q="user:kimchy")
+
     assert len(spans) == 1
     span = spans[0]
-    assert span["name"] == "ES GET /tweets,snaps/users,posts/_search"
-    assert span["type"] == "db"
-    assert span["subtype"] == "elasticsearch"
-    assert span["action"] == "query"
-    assert span["context"]["db"]["type"] == "elasticsearch"
-    assert span["context"]["http"]["status_code"] == 200
+    assert span["name"] == MULTIPLE_INDEXES_DOCTYPES_SEARCH_SPAN_NAME
+    assert_db_span(span, expect_statement=True)
 
 
 @pytest.mark.integrationtest
-def test_custom_serializer(instrument, elasticapm_client, elasticsearch):
+def test_custom_serializer(instrument, transaction_spans, elasticsearch):
     if ES_VERSION[0] < 7:
-        elasticsearch.index("test-index", document_type, {"2": 1})
+        elasticsearch.index(TEST_INDEX, document_type, {"2": 1}, refresh=True)
     else:
-        elasticsearch.index(index="test-index", body={"2": 1})
-    elasticapm_client.begin_transaction("test")
-    search_query = {"query": {"term": {NumberObj(2): {"value": 1}}}}
-    result = elasticsearch.search(index="test-index", body=search_query)
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
-    spans = elasticapm_client.spans_for_transaction(transaction)
+        elasticsearch.index(index=TEST_INDEX, body={"2": 1}, refresh=True)
+    with transaction_spans() as spans:
+        search_query = {"query": {"term": {NumberObj(2): {"value": 1}}}}
+        result = elasticsearch.search(index=TEST_INDEX, body=search_query)
+
     span = spans[0]
-    assert json.loads(span["context"]["db"]["statement"]) == json.loads('{"query":{"term":{"2":{"value":1}}}}')
-    assert span["context"]["http"]["status_code"] == 200
+    assert_db_span(span, expect_statement=True)
+    assert json_loads(span["context"]["db"]["statement"]) == {"query": {"term": {"2": {"value": 1}}}}
 
 
 @pytest.mark.integrationtest
-def test_dropped_span(instrument, elasticapm_client, elasticsearch):
-    elasticapm_client.begin_transaction("test")
-    with elasticapm.capture_span("test", leaf=True):
-        elasticsearch.ping()
-    elasticapm_client.end_transaction("test", "OK")
-
-    transaction = elasticapm_client.events[TRANSACTION][0]
-    spans = elasticapm_client.spans_for_transaction(transaction)
+def test_dropped_span(instrument, transaction_spans, elasticsearch):
+    with transaction_spans() as spans:
+        with elasticapm.capture_span("test", leaf=True):
+            elasticsearch.ping()
+
     assert len(spans) == 1
     span = spans[0]
     assert span["name"] == "test"
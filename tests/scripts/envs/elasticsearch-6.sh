@@ -1,4 +1,4 @@
-export PYTEST_MARKER="-m elasticsearch"
+export PYTEST_MARKER="-m elasticsearch -n auto"
 export ES_URL="http://elasticsearch6:9200"
 export DOCKER_DEPS="elasticsearch6"
 export WAIT_FOR_HOST="elasticsearch6"